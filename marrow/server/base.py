@@ -97,7 +97,12 @@ class Server(object):
         
         return 1
     
-    def serve(self, master=True, io_loop=None):
+    def prepare(self, io_loop=None):
+        """Instantiate the protocol and execute startup hooks without accepting connections.
+        
+        This is used by serve, and directly by testing rigs which hand streams to the protocol themselves.
+        """
+        
         self.io_loop = io_loop or ioloop.IOLoop.instance()
         
         if isclass(self.protocol):
@@ -113,6 +118,9 @@ class Server(object):
         
         for callback in self.callbacks['start']:
             callback(self)
+    
+    def serve(self, master=True, io_loop=None):
+        self.prepare(io_loop)
         
         # Register for new connection notifications.
         self.io_loop.add_handler(
@@ -151,6 +159,10 @@ class Server(object):
         socket.bind(self.address)
         socket.listen(self.pool)
         
+        # Record the port actually bound, in case an ephemeral one was requested.
+        if isinstance(self.address, tuple):
+            self.address = (self.address[0], socket.getsockname()[1])
+        
         if self.fork is None:
             self.fork = self.processors()
         elif self.fork < 1:
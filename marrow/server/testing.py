@@ -1,56 +1,267 @@
 # encoding: utf-8
 
-"""Unit testing helpers for asynchronous marrow.io IOLoop and IOStream.
+"""Unit testing helpers for asynchronous marrow.server protocols.
 
-This is a barely-modified version of the unit testing rig from Tornado.
+ServerTestCase runs a real TCP listener bound to an ephemeral port.  LoopbackTestCase skips the listener entirely,
+handing one end of a connected socket pair directly to the protocol's accept method.  Neither claims a fixed port, so
+test suites may safely be run in parallel.
+
+Both provide converse(), which runs many scripted clients concurrently against the protocol under test.
 """
 
+import sys
+import time
 import socket
 
-from marrow.io.testing import AsyncTestCase
-from marrow.io.iostream import IOStream
+from functools import partial
+from unittest import TestCase
+
+try:
+    from tornado import ioloop, iostream
+except ImportError:
+    from marrow.io import ioloop, iostream
+
 from marrow.server.base import Server
 
 
-_next_port = 3000
 log = __import__('logging').getLogger(__name__)
-__all__ = ['ServerTestCase']
+__all__ = ['AsyncTestCase', 'ProtocolTestCase', 'ServerTestCase', 'LoopbackTestCase', 'get_unused_port']
 
 
 
 def get_unused_port():
-    global _next_port
-    port = _next_port
-    _next_port += 1
-    return port
+    """Ask the operating system for an unused ephemeral port.
+    
+    Prefer binding directly to port zero where possible; the port returned here may be claimed by another process
+    before it is used.
+    """
+    
+    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    
+    try:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+    finally:
+        s.close()
+
+
+class AsyncTestCase(TestCase):
+    """A TestCase running its own IOLoop.
+    
+    Begin an asynchronous operation passing self.stop as the callback, then call self.wait() to run the IOLoop until
+    self.stop is called.  The value passed to stop is returned by wait.  Exceptions raised within IOLoop callbacks, or
+    the operation not completing in time, fail the test.
+    """
+    
+    timeout = 5
+    
+    def setUp(self):
+        super(AsyncTestCase, self).setUp()
+        
+        self.io_loop = ioloop.IOLoop()
+        self.io_loop.handle_callback_exception = self._exception
+        
+        self._running = False
+        self._stopped = False
+        self._result = None
+        self._failure = None
+    
+    def tearDown(self):
+        close = getattr(self.io_loop, 'close', None)
+        if close: close(all_fds=True)
+        
+        self.io_loop = None
+        super(AsyncTestCase, self).tearDown()
+    
+    def _exception(self, callback):
+        self._failure = sys.exc_info()[1]
+        self.stop()
+    
+    def stop(self, result=None):
+        self._result = result
+        self._stopped = True
+        
+        if self._running:
+            self._running = False
+            self.io_loop.stop()
+    
+    def wait(self, timeout=None):
+        timeout = timeout or self.timeout
+        
+        if not self._stopped:
+            def expired():
+                self._failure = AssertionError("Asynchronous operation timed out after %s seconds." % (timeout, ))
+                self.stop()
+            
+            deadline = self.io_loop.add_timeout(time.time() + timeout, expired)
+            self._running = True
+            
+            try:
+                self.io_loop.start()
+            finally:
+                self._running = False
+                self.io_loop.remove_timeout(deadline)
+        
+        self._stopped = False
+        failure, self._failure = self._failure, None
+        result, self._result = self._result, None
+        
+        if failure is not None:
+            raise failure
+        
+        return result
 
 
-class ServerTestCase(AsyncTestCase):
+class ProtocolTestCase(AsyncTestCase):
+    """Exercise a protocol class attribute through client streams.
+    
+    Subclasses determine how the protocol is served and how clients connect to it.  A client is connected during
+    setUp and made available as self.client; all clients are closed during tearDown.
+    """
+    
     protocol = None
     arguments = dict()
     
     def __init__(self, *args, **kwargs):
-        super(ServerTestCase, self).__init__(*args, **kwargs)
+        super(ProtocolTestCase, self).__init__(*args, **kwargs)
         self.server = None
-        self.port = None
         self.client = None
+        self.clients = []
     
     def setUp(self):
-        super(ServerTestCase, self).setUp()
+        super(ProtocolTestCase, self).setUp()
         
-        self.port = get_unused_port()
-        self.server = Server('127.0.0.1', self.port, self.protocol, **self.arguments)
-        self.server.start(io_loop=self.io_loop)
+        self.server = self.serve()
+        self.client = self.connect()
+    
+    def tearDown(self):
+        for client in self.clients:
+            if not client.closed():
+                client.close()
         
-        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM, 0)
-        s.connect(("127.0.0.1", self.port))
-        s.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
-        s.setblocking(0)
+        self.server.stop(io_loop=self.io_loop)
+        
+        self.client = None
+        self.clients = []
+        self.server = None
+        
+        super(ProtocolTestCase, self).tearDown()
+    
+    def serve(self):
+        """Prepare and return the Server hosting the protocol under test."""
+        raise NotImplementedError()
+    
+    def connect(self):
+        """Return a new client IOStream connected to the protocol under test."""
+        raise NotImplementedError()
+    
+    def converse(self, scripts, timeout=None):
+        """Run many scripted clients concurrently, each on its own new connection.
+        
+        Each script is a sequence of (send, expect) steps.  The data to send, if any, is written, then a response is
+        read up to and including the expect delimiter, or exactly that many bytes if expect is an integer.  If expect
+        is None nothing is read.
+        
+        Returns a list, in script order, of the responses each client received.
+        """
         
-        self.client = IOStream(s, self.io_loop)
+        scripts = [iter(script) for script in scripts]
+        results = [[] for script in scripts]
+        remaining = [len(scripts)]
+        
+        def step(client, steps, responses, data=None):
+            if data is not None:
+                responses.append(data)
+            
+            try:
+                send, expect = next(steps)
+            except StopIteration:
+                remaining[0] -= 1
+                if not remaining[0]: self.stop(results)
+                return
+            
+            callback = partial(step, client, steps, responses)
+            
+            if send:
+                client.write(send)
+            
+            if expect is None:
+                self.io_loop.add_callback(callback)
+            elif isinstance(expect, int):
+                client.read_bytes(expect, callback)
+            else:
+                client.read_until(expect, callback)
+        
+        if not scripts:
+            return results
+        
+        for steps, responses in zip(scripts, results):
+            step(self.connect(), steps, responses)
+        
+        return self.wait(timeout)
+
+
+class ServerTestCase(ProtocolTestCase):
+    """Exercise a protocol served by a real TCP listener on an ephemeral loopback port."""
+    
+    def __init__(self, *args, **kwargs):
+        super(ServerTestCase, self).__init__(*args, **kwargs)
+        self.port = None
     
     def tearDown(self):
+        self.io_loop.remove_handler(self.server.socket.fileno())
+        self.server.socket.close()
+        
         super(ServerTestCase, self).tearDown()
-        self.client = None
         self.port = None
-        self.server = None
+    
+    def serve(self):
+        server = Server('127.0.0.1', 0, self.protocol, **self.arguments)
+        server.start(io_loop=self.io_loop)
+        
+        self.port = server.address[1]
+        
+        return server
+    
+    def connect(self):
+        """Begin connecting a new client, returning its IOStream immediately.
+        
+        The connection completes once the IOLoop runs; writes and reads issued before then are queued by the stream.
+        Connecting without blocking lets converse() open more clients than the listen backlog holds.
+        """
+        
+        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM, 0)
+        s.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        s.setblocking(0)
+        
+        client = iostream.IOStream(s, io_loop=self.io_loop)
+        client.connect(("127.0.0.1", self.port))
+        self.clients.append(client)
+        
+        return client
+
+
+class LoopbackTestCase(ProtocolTestCase):
+    """Exercise a protocol without a listening socket.
+    
+    Each client is one end of a connected socket pair, the other end of which is passed directly to the protocol's
+    accept method.  No port is bound and no connection handshake takes place.
+    """
+    
+    def serve(self):
+        server = Server(None, None, self.protocol, **self.arguments)
+        server.prepare(self.io_loop)
+        
+        return server
+    
+    def connect(self):
+        client, remote = socket.socketpair()
+        client.setblocking(0)
+        remote.setblocking(0)
+        
+        self.server.protocol.accept(iostream.IOStream(remote, io_loop=self.io_loop))
+        
+        client = iostream.IOStream(client, io_loop=self.io_loop)
+        self.clients.append(client)
+        
+        return client
@@ -0,0 +1,361 @@
+# encoding: utf-8
+
+"""Pooled, non-blocking connections to upstream services.
+
+Protocols which forward requests to backend services can acquire an already-connected stream from an UpstreamPool
+rather than paying the full connect latency for every request.  Each upstream address has its own connection limit;
+once reached, further requests are queued and served in order as connections are released back to the pool.
+
+The pool lives on the server's IOLoop, so the natural place to create it is within Protocol.start:
+
+    class ProxyProtocol(Protocol):
+        def start(self):
+            self.upstream = UpstreamPool(self.server.io_loop, limit=16)
+
+        def stop(self):
+            self.upstream.close()
+
+        def accept(self, client):
+            self.upstream.acquire(('127.0.0.1', 8080), partial(self.on_upstream, client))
+
+        def on_upstream(self, client, upstream):
+            if upstream is None:
+                client.close()  # Connection refused, timed out, or the wait queue is full.
+                return
+
+            ...
+
+            self.upstream.release(upstream)
+
+Only release a stream once the response it was used for has been entirely consumed; streams which are closed or have
+a read pending when released are discarded rather than reused.
+"""
+
+import os
+import time
+import errno
+import socket
+
+from collections import deque
+from functools import partial
+
+try:
+    from tornado import ioloop, iostream
+except ImportError:
+    from marrow.io import ioloop, iostream
+
+
+__all__ = ['UpstreamPool']
+log = __import__('logging').getLogger(__name__)
+
+_pending = (errno.EINPROGRESS, errno.EWOULDBLOCK, errno.EAGAIN, getattr(errno, 'WSAEWOULDBLOCK', errno.EWOULDBLOCK))
+
+
+
+class Upstream(object):
+    """Connection bookkeeping for a single upstream address."""
+    
+    def __repr__(self):
+        return "Upstream(%r, %d idle, %d active, %d connecting, %d waiting)" % (
+                self.address, len(self.idle), len(self.active), self.connecting, len(self.waiters))
+    
+    def __init__(self, address):
+        self.address = address
+        self.idle = deque()  # (stream, released) pairs, most recently released on the right.
+        self.waiters = deque()
+        self.active = set()  # Streams currently checked out.
+        self.connecting = 0
+    
+    @property
+    def size(self):
+        return len(self.idle) + len(self.active) + self.connecting
+
+
+class UpstreamPool(object):
+    """A non-blocking pool of keepalive connections to upstream services.
+    
+    Connections are tracked per upstream address.  Idle connections are reused most-recently-released first and are
+    evicted once older than the keepalive period or when closed by the remote end.
+    """
+    
+    def __repr__(self):
+        return "UpstreamPool(%d upstreams, %d connections)" % (len(self.upstreams), len(self.owners))
+    
+    def __init__(self, io_loop=None, limit=10, keepalive=60, timeout=5, queue=None):
+        """Configure the pool.
+        
+        The limit is the maximum number of connections, idle, active, or connecting, per upstream address.  Idle
+        connections older than keepalive seconds are closed rather than reused, and are swept from every upstream
+        twice per keepalive period whether or not further requests arrive.  Connection attempts taking longer
+        than timeout seconds are abandoned; None disables the timeout.
+        
+        If queue is None an unlimited number of requests may wait for a connection when an upstream is at its limit,
+        otherwise requests beyond that many waiters are immediately rejected.
+        """
+        
+        super(UpstreamPool, self).__init__()
+        
+        self.io_loop = io_loop or ioloop.IOLoop.instance()
+        self.limit = limit
+        self.keepalive = keepalive
+        self.timeout = timeout
+        self.queue = queue
+        
+        self.closed = False
+        self.upstreams = dict()
+        self.owners = dict()
+        
+        self.sweeper = None
+        
+        if keepalive > 0:
+            self.sweeper = ioloop.PeriodicCallback(self._sweep, keepalive * 500, io_loop=self.io_loop)
+            self.sweeper.start()
+    
+    def acquire(self, address, callback):
+        """Request a connected stream to the given address.
+        
+        The address is either a numeric (host, port) tuple or the path to an on-disk UNIX domain socket.  Host names
+        are not resolved, as doing so would block the IOLoop; resolve them ahead of time.  The callback is executed
+        with the stream once available, or with None if the connection could not be established or the request
+        could not be queued.
+        """
+        
+        if self.closed:
+            log.warn("Refusing to acquire connection to %r from closed pool.", address)
+            self.io_loop.add_callback(partial(callback, None))
+            return
+        
+        upstream = self.upstreams.get(address)
+        
+        if upstream is None:
+            upstream = self.upstreams[address] = Upstream(address)
+        
+        self._prune(upstream)
+        
+        while upstream.idle:
+            stream = upstream.idle.pop()[0]
+            
+            if self._healthy(stream):
+                self._checkout(upstream, stream, callback)
+                return
+            
+            self._discard(stream)
+        
+        if upstream.size < self.limit:
+            self._connect(upstream, callback)
+            return
+        
+        if self.queue is not None and len(upstream.waiters) >= self.queue:
+            log.warn("Wait queue for upstream %r is full; rejecting request.", address)
+            self.io_loop.add_callback(partial(callback, None))
+            return
+        
+        upstream.waiters.append(callback)
+    
+    def release(self, stream, reuse=True):
+        """Return a previously acquired stream to the pool.
+        
+        Pass reuse=False to close the connection instead, e.g. when the upstream response was not fully consumed.
+        """
+        
+        upstream = self.owners.get(stream)
+        
+        if upstream is None:
+            log.warn("Released stream %r does not belong to this pool; closing.", stream)
+            stream.close()
+            return
+        
+        if stream not in upstream.active:
+            log.warn("Ignoring release of stream %r which is not checked out.", stream)
+            return
+        
+        upstream.active.discard(stream)
+        
+        # Check health before handing the stream to a waiter as well as when it is later taken from the idle pool.
+        if self.closed or not reuse or stream.reading() or not self._healthy(stream):
+            self._discard(stream)
+            self._dispatch(upstream)
+            return
+        
+        if upstream.waiters:
+            self._checkout(upstream, stream, upstream.waiters.popleft())
+            return
+        
+        stream.set_close_callback(partial(self._closed, upstream, stream))
+        upstream.idle.append((stream, time.time()))
+    
+    def close(self):
+        """Close all idle connections and reject all waiting requests.
+        
+        Connection attempts still in progress are abandoned as they complete; active connections are closed as they
+        are released.
+        """
+        
+        self.closed = True
+        
+        if self.sweeper is not None:
+            self.sweeper.stop()
+        
+        for upstream in self.upstreams.values():
+            while upstream.idle:
+                self._discard(upstream.idle.pop()[0])
+            
+            while upstream.waiters:
+                self.io_loop.add_callback(partial(upstream.waiters.popleft(), None))
+    
+    def _sweep(self):
+        """Periodically evict expired idle connections from every upstream, including those no longer in use."""
+        
+        for upstream in self.upstreams.values():
+            self._prune(upstream)
+    
+    def _prune(self, upstream):
+        """Evict idle connections which have outlived the keepalive period.
+        
+        The oldest connections are on the left, so this stops at the first connection still within its keepalive.
+        """
+        
+        expired = time.time() - self.keepalive
+        
+        while upstream.idle and (upstream.idle[0][1] < expired or upstream.idle[0][0].closed()):
+            self._discard(upstream.idle.popleft()[0])
+    
+    def _healthy(self, stream):
+        """Determine if an idle connection is still usable.
+        
+        An idle stream has no read pending, so a remote hang-up may not have been noticed yet; peek at the socket to
+        find out.  Any unsolicited data from the upstream, whether already read into the stream's buffer or still
+        waiting on the socket, also renders the connection unusable.
+        """
+        
+        if stream.closed():
+            return False
+        
+        buffered = getattr(stream, '_read_buffer_size', None)
+        if buffered is None: buffered = len(getattr(stream, '_read_buffer', ()))
+        
+        if buffered:
+            log.debug("Discarding idle connection with %d bytes of unsolicited data.", buffered)
+            return False
+        
+        try:
+            stream.socket.recv(1, socket.MSG_PEEK)
+        except socket.error as e:
+            return e.args[0] in _pending
+        
+        return False
+    
+    def _checkout(self, upstream, stream, callback):
+        stream.set_close_callback(None)
+        upstream.active.add(stream)
+        self.io_loop.add_callback(partial(callback, stream))
+    
+    def _discard(self, stream):
+        self.owners.pop(stream, None)
+        stream.set_close_callback(None)
+        
+        if not stream.closed():
+            stream.close()
+    
+    def _closed(self, upstream, stream):
+        """An idle connection was closed by the remote end."""
+        
+        log.debug("Idle connection to upstream %r closed.", upstream.address)
+        
+        self.owners.pop(stream, None)
+        
+        for i, (candidate, released) in enumerate(upstream.idle):
+            if candidate is stream:
+                del upstream.idle[i]
+                break
+        
+        self._dispatch(upstream)
+    
+    def _dispatch(self, upstream):
+        """Hand freed capacity to waiting requests."""
+        
+        while upstream.waiters and upstream.size < self.limit:
+            self._connect(upstream, upstream.waiters.popleft())
+    
+    def _connect(self, upstream, callback):
+        upstream.connecting += 1
+        
+        try:
+            sock, address = self._socket(upstream.address)
+        except socket.error as e:
+            self._failed(upstream, callback, e)
+            return
+        
+        try:
+            error = sock.connect_ex(address)
+        except socket.error as e:
+            error = e.args[0]
+        
+        if error and error not in _pending:
+            sock.close()
+            self._failed(upstream, callback, socket.error(error, os.strerror(error)))
+            return
+        
+        fd = sock.fileno()
+        deadline = None
+        
+        def connected(fd, events):
+            self.io_loop.remove_handler(fd)
+            if deadline is not None: self.io_loop.remove_timeout(deadline)
+            
+            if self.closed:
+                sock.close()
+                upstream.connecting -= 1
+                callback(None)
+                return
+            
+            error = sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+            
+            if error:
+                sock.close()
+                self._failed(upstream, callback, socket.error(error, os.strerror(error)))
+                return
+            
+            stream = iostream.IOStream(sock, io_loop=self.io_loop)
+            self.owners[stream] = upstream
+            
+            upstream.connecting -= 1
+            upstream.active.add(stream)
+            
+            callback(stream)
+        
+        def expired():
+            self.io_loop.remove_handler(fd)
+            sock.close()
+            self._failed(upstream, callback, "timed out after %s seconds" % (self.timeout, ))
+        
+        if self.timeout is not None:
+            deadline = self.io_loop.add_timeout(time.time() + self.timeout, expired)
+        
+        self.io_loop.add_handler(fd, connected, self.io_loop.WRITE | self.io_loop.ERROR)
+    
+    def _failed(self, upstream, callback, reason):
+        log.warn("Unable to connect to upstream %r: %s", upstream.address, reason)
+        
+        upstream.connecting -= 1
+        self.io_loop.add_callback(partial(callback, None))
+        self._dispatch(upstream)
+    
+    def _socket(self, address):
+        """Create a non-blocking socket suitable for connecting to the given address."""
+        
+        if not isinstance(address, tuple):
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            sock.setblocking(0)
+            return sock, address
+        
+        # Numeric lookups never touch the resolver, so can not block the IOLoop.
+        flags = socket.AI_NUMERICHOST | getattr(socket, 'AI_NUMERICSERV', 0)
+        family, kind, protocol, cname, sa = socket.getaddrinfo(
+                address[0], address[1], 0, socket.SOCK_STREAM, 0, flags)[0]
+        
+        sock = socket.socket(family, kind, protocol)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        sock.setblocking(0)
+        
+        return sock, sa
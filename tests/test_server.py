@@ -2,15 +2,9 @@
 
 from __future__ import unicode_literals
 
-import time
-import socket
-
-from unittest import TestCase
 from functools import partial
 
-from marrow.io.iostream import IOStream
-from marrow.server.base import Server
-from marrow.server.testing import ServerTestCase
+from marrow.server.testing import ServerTestCase, LoopbackTestCase
 from marrow.server.protocol import Protocol
 
 
@@ -31,3 +25,48 @@ class TestProtocol(ServerTestCase):
         self.client.read_until(b"\n", self.stop)
         self.assertEquals(self.wait(), b"Welcome.\n")
 
+
+class EchoProtocol(Protocol):
+    def accept(self, client):
+        client.read_until(b"\n", partial(self.on_line, client))
+    
+    def on_line(self, client, data):
+        client.write(data)
+        client.read_until(b"\n", partial(self.on_line, client))
+
+
+class TestLoopback(LoopbackTestCase):
+    protocol = SimpleProtocol
+    
+    def test_serving(self):
+        self.client.read_until(b"\n", self.stop)
+        self.assertEquals(self.wait(), b"Welcome.\n")
+
+
+class TestConversation(LoopbackTestCase):
+    protocol = EchoProtocol
+    
+    def test_concurrent_clients(self):
+        scripts = [[(("%d.%d\n" % (i, j)).encode('ascii'), b"\n") for j in range(5)] for i in range(50)]
+        results = self.converse(scripts)
+        
+        self.assertEquals(results, [[line for line, expect in script] for script in scripts])
+    
+    def test_fixed_length(self):
+        self.assertEquals(self.converse([[(b"ping\n", 5)], [(b"pong\n", None), (None, 5)]]), [[b"ping\n"], [b"pong\n"]])
+
+
+class TestServerConversation(ServerTestCase):
+    protocol = EchoProtocol
+    
+    def test_ephemeral_port(self):
+        self.assertNotEquals(self.port, 0)
+    
+    def test_concurrent_clients(self):
+        results = self.converse([[(b"hello\n", b"\n")]] * 10)
+        self.assertEquals(results, [[b"hello\n"]] * 10)
+    
+    def test_beyond_backlog(self):
+        clients = self.server.pool + 200
+        results = self.converse([[(b"hello\n", b"\n")]] * clients)
+        self.assertEquals(results, [[b"hello\n"]] * clients)
@@ -0,0 +1,215 @@
+# encoding: utf-8
+
+from __future__ import unicode_literals
+
+import time
+import socket
+
+from functools import partial
+
+from marrow.server.testing import ServerTestCase, get_unused_port
+from marrow.server.protocol import Protocol
+from marrow.server.upstream import UpstreamPool
+
+
+log = __import__('logging').getLogger(__name__)
+
+
+
+class BackendProtocol(Protocol):
+    """A stand-in backend echoing lines.
+    
+    After echoing "extra" a further unsolicited line is sent; after echoing "bye" the connection is closed.
+    """
+    
+    hangups = 0
+    on_hangup = None
+    
+    def accept(self, client):
+        client.read_until(b"\n", partial(self.on_line, client))
+    
+    def on_line(self, client, data):
+        if data == b"bye\n":
+            client.write(data, partial(self.hangup, client))
+            return
+        
+        if data == b"extra\n":
+            data += b"UNSOLICITED\n"
+        
+        client.write(data)
+        client.read_until(b"\n", partial(self.on_line, client))
+    
+    def hangup(self, client):
+        client.close()
+        self.hangups += 1
+        
+        if self.on_hangup:
+            self.on_hangup()
+
+
+class TestUpstreamPool(ServerTestCase):
+    protocol = BackendProtocol
+    
+    def setUp(self):
+        super(TestUpstreamPool, self).setUp()
+        self.address = ('127.0.0.1', self.port)
+        self.pool = UpstreamPool(self.io_loop, limit=1, timeout=1)
+    
+    def tearDown(self):
+        self.pool.close()
+        self.pool = None
+        super(TestUpstreamPool, self).tearDown()
+    
+    def acquire(self):
+        self.pool.acquire(self.address, self.stop)
+        return self.wait()
+    
+    def echo(self, stream, line):
+        stream.write(line)
+        stream.read_until(b"\n", self.stop)
+        return self.wait()
+    
+    def test_acquire(self):
+        stream = self.acquire()
+        self.assertTrue(stream is not None)
+        self.assertEquals(self.echo(stream, b"hello\n"), b"hello\n")
+    
+    def test_keepalive_reuse(self):
+        stream = self.acquire()
+        self.echo(stream, b"hello\n")
+        self.pool.release(stream)
+        
+        self.assertTrue(self.acquire() is stream)
+    
+    def test_release_without_reuse(self):
+        stream = self.acquire()
+        self.pool.release(stream, reuse=False)
+        
+        self.assertTrue(stream.closed())
+        self.assertTrue(self.acquire() is not stream)
+    
+    def test_waiters_are_queued(self):
+        stream = self.acquire()
+        
+        self.pool.acquire(self.address, self.stop)
+        self.assertEquals(len(self.pool.upstreams[self.address].waiters), 1)
+        
+        self.pool.release(stream)
+        self.assertTrue(self.wait() is stream)
+    
+    def test_queue_limit(self):
+        self.pool.queue = 0
+        self.acquire()
+        
+        self.assertTrue(self.acquire() is None)
+    
+    def test_double_release(self):
+        stream = self.acquire()
+        self.pool.release(stream)
+        self.pool.release(stream)
+        
+        upstream = self.pool.upstreams[self.address]
+        self.assertEquals(len(upstream.idle), 1)
+        self.assertEquals(len(upstream.active), 0)
+        self.assertEquals(upstream.size, 1)
+    
+    def test_unsolicited_data_evicts(self):
+        stream = self.acquire()
+        self.assertEquals(self.echo(stream, b"extra\n"), b"extra\n")
+        self.pool.release(stream)
+        
+        replacement = self.acquire()
+        self.assertTrue(replacement is not stream)
+        self.assertEquals(self.echo(replacement, b"hello\n"), b"hello\n")
+    
+    def test_unsolicited_data_not_handed_to_waiter(self):
+        stream = self.acquire()
+        self.assertEquals(self.echo(stream, b"extra\n"), b"extra\n")
+        
+        self.pool.acquire(self.address, self.stop)
+        self.pool.release(stream)
+        
+        replacement = self.wait()
+        self.assertTrue(replacement is not None and replacement is not stream)
+        self.assertTrue(stream.closed())
+        self.assertEquals(self.echo(replacement, b"hello\n"), b"hello\n")
+    
+    def test_remote_close_evicts(self):
+        stream = self.acquire()
+        self.assertEquals(self.echo(stream, b"bye\n"), b"bye\n")
+        self.pool.release(stream)
+        
+        # Wait for the backend to hang up on what is now an idle connection.
+        protocol = self.server.protocol
+        
+        if not protocol.hangups:
+            protocol.on_hangup = self.stop
+            self.wait()
+        
+        replacement = self.acquire()
+        self.assertTrue(replacement is not stream)
+        self.assertEquals(self.echo(replacement, b"again\n"), b"again\n")
+    
+    def test_keepalive_expiry(self):
+        self.pool.keepalive = -1
+        stream = self.acquire()
+        self.pool.release(stream)
+        
+        self.assertTrue(self.acquire() is not stream)
+        self.assertTrue(stream.closed())
+    
+    def test_idle_sweep(self):
+        self.pool.close()
+        self.pool = UpstreamPool(self.io_loop, keepalive=0.05)
+        
+        stream = self.acquire()
+        self.pool.release(stream)
+        
+        # No further requests are made; the periodic sweep alone must evict the connection.
+        self.io_loop.add_timeout(time.time() + 0.2, self.stop)
+        self.wait()
+        
+        self.assertTrue(stream.closed())
+        self.assertEquals(len(self.pool.upstreams[self.address].idle), 0)
+    
+    def test_connect_timeout(self):
+        listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        listener.bind(('127.0.0.1', 0))
+        listener.listen(0)
+        address = listener.getsockname()
+        
+        # Fill the listen backlog so that further connection attempts are never completed.
+        backlog = []
+        
+        try:
+            for i in range(5):
+                s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+                s.setblocking(0)
+                s.connect_ex(address)
+                backlog.append(s)
+            
+            self.pool.timeout = 0.2
+            self.pool.acquire(address, self.stop)
+            
+            self.assertTrue(self.wait() is None)
+            self.assertEquals(self.pool.upstreams[address].connecting, 0)
+        finally:
+            for s in backlog:
+                s.close()
+            
+            listener.close()
+    
+    def test_close_abandons_pending_connect(self):
+        self.pool.acquire(self.address, self.stop)
+        self.pool.close()
+        
+        self.assertTrue(self.wait() is None)
+        self.assertEquals(self.pool.upstreams[self.address].connecting, 0)
+    
+    def test_connection_refused(self):
+        self.pool.acquire(('127.0.0.1', get_unused_port()), self.stop)
+        self.assertTrue(self.wait() is None)
+    
+    def test_hostnames_are_not_resolved(self):
+        self.pool.acquire(('localhost', self.port), self.stop)
+        self.assertTrue(self.wait() is None)